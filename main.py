@@ -1,25 +1,242 @@
 import argparse
 import asyncio
 import csv
+import heapq
 import json
+import multiprocessing
 import os
 import sqlite3
 import re
+import time
 from collections import Counter, defaultdict
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
 from typing import Dict, List, Tuple
+from urllib.request import pathname2url
 
 from dotenv import load_dotenv
 from pyrogram import Client
 from pyrogram.errors import ChatForbidden, ChatWriteForbidden, FloodWait
 from pyrogram.types import Message, Chat
 
+# Слова длиной >= 2 символов
+_WORD_RE = re.compile(r'\b\w{2,}\b')
+# То же для ASCII-текстов: на них результат совпадает, а поиск заметно быстрее
+_ASCII_WORD_RE = re.compile(r'\b\w{2,}\b', re.ASCII)
+
+# ID чата (у групп и каналов отрицательный) и дата в формате день.месяц.год:
+# ввод проверяется одним сопоставлением, без разбора через исключения
+_INT_RE = re.compile(r'-?\d+')
+_DATE_RE = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})')
+
+# Русские и английские предлоги, союзы и другие незначимые слова
+_STOP_WORDS = frozenset({
+    'и', 'в', 'на', 'с', 'по', 'за', 'до', 'о', 'у', 'а', 'но', 'или', 'же',
+    'то', 'не', 'что', 'как', 'это', 'бы', 'был', 'была', 'было', 'так', 'вот', 'ли',
+    'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of',
+    'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have', 'has', 'had',
+    'will', 'would', 'could', 'should', 'may', 'might', 'can', 'this', 'that', 'these', 'those'
+})
+
+# Имена участников хранятся один раз в users, а в messages - только sender_id
+_CREATE_MESSAGES_SQL = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        date INTEGER,
+        sender_id INTEGER,
+        text TEXT,
+        media_type TEXT,
+        sticker_emoji TEXT,
+        sticker_file_id TEXT,
+        sticker_set_name TEXT
+    )
+"""
+# last_message_id - сообщение, из которого взяты имена (самое новое из загруженных)
+_CREATE_USERS_SQL = """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        last_message_id INTEGER
+    )
+"""
+# Готовая статистика за период; она действительна, пока в messages не появились
+# новые строки (max_message_id и message_count совпадают с текущими).
+# Границы периода хранятся строками: '' - без ограничения (NULL в ключе не совпадал бы сам с собой).
+# payload - JSON, как и в кэше диалогов: базу чата передают между людьми,
+# и чтение кэша не должно выполнять код (как pickle)
+_CREATE_STATS_CACHE_SQL = """
+    CREATE TABLE IF NOT EXISTS stats_cache (
+        chat_id INTEGER,
+        start_date TEXT,
+        end_date TEXT,
+        max_message_id INTEGER,
+        message_count INTEGER,
+        version INTEGER,
+        payload TEXT,
+        computed_at REAL,
+        PRIMARY KEY (chat_id, start_date, end_date)
+    )
+"""
+# Увеличивается при изменении формата статистики, чтобы не читать старые результаты
+_STATS_CACHE_VERSION = 2
+
+# Вставка строки, построенной _message_row; один и тот же текст запроса
+# позволяет sqlite3 брать подготовленный statement из своего кэша
+_INSERT_MESSAGE_SQL = "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+# Имена участника обновляются, только если они взяты из более нового сообщения
+_UPSERT_USER_SQL = """
+    INSERT INTO users VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        last_message_id = excluded.last_message_id
+    WHERE excluded.last_message_id > users.last_message_id
+"""
+
+# Дата сообщения хранится в секундах Unix (UTC), номер дня - date / 86400
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Слова по пользователям считаются в нескольких процессах только для больших чатов:
+# запуск процессов (с импортом зависимостей) занимает порядка секунды, а это
+# сравнимо со временем разбора миллиона сообщений в одном процессе
+_PARALLEL_MIN_MESSAGES = 1000000
+_MAX_WORD_WORKERS = 8
+
+# Группа в списке чатов по типу чата. В Pyrogram 2 chat.type - перечисление ChatType,
+# его value совпадает со строковым типом из Pyrogram 1
+_CHAT_TYPE_GROUPS = {
+    "channel": "channels",
+    "group": "groups",
+    "supergroup": "groups",
+    "private": "private",
+}
+
+# Заголовки групп в списке чатов, в порядке вывода
+_CHAT_GROUP_HEADERS = {
+    "channels": "КАНАЛЫ",
+    "groups": "ГРУППЫ",
+    "private": "ЛИЧНЫЕ ЧАТЫ",
+    "unnamed": "БЕЗ НАЗВАНИЯ",
+}
+
+# Чаты без сообщений при сортировке по дате оказываются в конце списка
+_DT_MIN = datetime.min
+
+# Кэш списка диалогов: повторный запуск в течение TTL не обходит все диалоги заново
+_DIALOGS_CACHE_PATH = "dialogs_cache.db"
+_DIALOGS_CACHE_TTL = 60  # секунд
+
+
+def _text_words(text: str) -> List[str]:
+    """Разбивает текст на слова в нижнем регистре без стоп-слов"""
+    lowered = text.lower()
+    word_re = _ASCII_WORD_RE if lowered.isascii() else _WORD_RE
+    # Список, а не генератор: длина нужна для подсчета слов по участникам,
+    # а Counter.update по списку из list comprehension не медленнее генератора
+    return [word for word in word_re.findall(lowered) if word not in _STOP_WORDS]
+
+
+def _day_date(day: int) -> date:
+    """Переводит номер дня с начала эпохи Unix в дату"""
+    return date.fromordinal(_EPOCH_ORDINAL + day)
+
+
+@lru_cache(maxsize=64)
+def parse_date(date_str: str) -> datetime:
+    """Парсит дату в формате день.месяц.год и возвращает datetime с UTC временной зоной"""
+    match = _DATE_RE.fullmatch(date_str)
+    if match:
+        try:
+            return datetime(int(match[3]), int(match[2]), int(match[1]), tzinfo=timezone.utc)
+        except ValueError:
+            pass  # Формат верный, но такого дня нет (например, 31.2.2023)
+    raise ValueError(f"Некорректный формат даты: {date_str}. Используйте формат: день.месяц.год")
+
+
+def _resolve_range(start_str: str, end_str: str) -> Tuple[datetime, datetime]:
+    """Парсит границы периода анализа (пустая строка или None - без границы)
+
+    Выбрасывает ValueError с описанием ошибки для пользователя.
+    """
+    start_date = parse_date(start_str) if start_str else None
+    end_date = parse_date(end_str) if end_str else None
+    # Проверяем корректность диапазона
+    if start_date and end_date and end_date < start_date:
+        raise ValueError("конечная дата не может быть раньше начальной")
+    return start_date, end_date
+
+
+def _latest_chats(chats: list, limit: int = None) -> list:
+    """Возвращает чаты (id, название, дата последнего сообщения) от новых к старым, не больше limit"""
+    if limit:
+        # Частичная выборка через кучу дешевле полной сортировки, когда limit мал
+        return heapq.nlargest(limit, chats, key=lambda chat: chat[2] or _DT_MIN)
+    return sorted(chats, key=lambda chat: chat[2] or _DT_MIN, reverse=True)
+
+
+def _format_chat_date(value: datetime) -> str:
+    """Форматирует дату последнего сообщения чата как ГГГГ-ММ-ДД ЧЧ:ММ:СС"""
+    if not value:
+        return "Нет данных"
+    # isoformat в несколько раз быстрее strftime, а срез отбрасывает
+    # смещение часового пояса, которого нет и в формате strftime
+    return value.isoformat(" ", "seconds")[:19]
+
+
+def _connect_readonly(db_path: str, cache_size_mb: int = 64) -> sqlite3.Connection:
+    """Открывает соединение только для чтения (в режиме WAL читатели не блокируют друг друга)"""
+    uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True)
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size=-{cache_size_mb * 1024}")  # отрицательное значение - в КБ
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+
+def _count_words_by_sender(db_path: str, query: str, params: list) -> Dict[int, Counter]:
+    """Считает слова по отправителям в текстах, выбранных запросом (sender_id, text)
+
+    Выполняется в отдельном процессе, поэтому открывает собственное соединение.
+    """
+    conn = _connect_readonly(db_path)
+    try:
+        words = defaultdict(Counter)
+        for sender_id, text in conn.execute(query, params):
+            if text:
+                words[sender_id].update(_text_words(text))
+        return words
+    finally:
+        conn.close()
+
+
+@lru_cache(maxsize=None)
+def _pack_link(set_name: str) -> str:
+    """Возвращает ссылку на стикерпак (или None, если стикерпак неизвестен)"""
+    return f"tg://addstickers?set={set_name}" if set_name else None
+
+
+@lru_cache(maxsize=None)
+def _day_month(day: int) -> str:
+    """Возвращает месяц дня в формате ГГГГ-ММ (дней в периоде немного, поэтому результат кэшируется)"""
+    return _day_date(day).strftime("%Y-%m")
+
 
 class ChatAnalyzer:
-    def __init__(self, session_name: str, api_id: int, api_hash: str):
+    def __init__(self, session_name: str, api_id: int, api_hash: str, use_wal: bool = True,
+                 cache_size_mb: int = 64):
         self.client = Client(session_name, api_id=api_id, api_hash=api_hash)
+        self.session_name = session_name
+        self.use_wal = use_wal  # WAL не поддерживается, например, на сетевых файловых системах
+        self.cache_size_mb = cache_size_mb  # Кэш страниц SQLite на каждое соединение
         self.db_conn = None
+        self.db_path = None
         self.chat_id = None
+        self._chat = None  # Объект чата, полученный при проверке доступа
         self.start_date = None
         self.end_date = None
 
@@ -30,114 +247,316 @@ class ChatAnalyzer:
 
         if self.start_date:
             query += " AND date >= ?"
-            params.append(self.start_date.isoformat())
+            params.append(int(self.start_date.timestamp()))
 
         if self.end_date:
             # Добавляем 1 день, чтобы включить все сообщения последнего дня
             end_date_inclusive = self.end_date + timedelta(days=1)
             query += " AND date < ?"
-            params.append(end_date_inclusive.isoformat())
+            params.append(int(end_date_inclusive.timestamp()))
 
         return query, params
 
     def init_db(self, db_path: str):
         """Инициализирует SQLite базу данных"""
-        self.db_conn = sqlite3.connect(db_path)
-        cursor = self.db_conn.cursor()
+        # Транзакциями управляем явно (BEGIN/COMMIT вокруг пачек вставок)
+        self.db_path = db_path
+        # check_same_thread=False: запись пачек идет из потока executor-а
+        self.db_conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+
+        # page_size применяется только к новой базе и до перехода в WAL
+        self.db_conn.execute("PRAGMA page_size=8192")
+        self.db_conn.execute(f"PRAGMA journal_mode={'WAL' if self.use_wal else 'DELETE'}")
+        self.db_conn.execute("PRAGMA synchronous=NORMAL")
+        self.db_conn.execute("PRAGMA temp_store=MEMORY")
+        self.db_conn.execute(f"PRAGMA cache_size=-{self.cache_size_mb * 1024}")  # отрицательное значение - в КБ
+        self.db_conn.execute("PRAGMA mmap_size=268435456")  # 256 МБ
+
+        self.db_conn.execute(_CREATE_MESSAGES_SQL)
+        self.db_conn.execute(_CREATE_USERS_SQL)
+        self.db_conn.execute(_CREATE_STATS_CACHE_SQL)
+        self._migrate_schema()
+
+    @contextmanager
+    def _transaction(self):
+        """Выполняет блок в явной транзакции: COMMIT при успехе, ROLLBACK при ошибке"""
+        # Без ROLLBACK неудачная пачка оставила бы транзакцию открытой,
+        # и BEGIN следующей пачки завершился бы ошибкой.
+        # IMMEDIATE берет блокировку записи сразу, а не при первой вставке
+        self.db_conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            # При SQLITE_FULL, IOERR и т.п. SQLite уже откатил транзакцию сам,
+            # и лишний ROLLBACK заменил бы исходную ошибку своей
+            if self.db_conn.in_transaction:
+                self.db_conn.execute("ROLLBACK")
+            raise
+        self.db_conn.execute("COMMIT")
+
+    def _migrate_schema(self):
+        """Переводит базу, созданную старой версией, на текущую схему
+
+        Старые версии хранили имена отправителя в каждой строке messages,
+        а самые первые - еще и дату в ISO формате вместо секунд Unix.
+        """
+        columns = {name for _, name, *_ in self.db_conn.execute("PRAGMA table_info(messages)")}
+        if "sender_first_name" not in columns:
+            return
 
-        # Создаем таблицу с индексами для улучшения производительности
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY,
-                date TEXT,
-                sender_id INTEGER,
-                sender_username TEXT,
-                sender_first_name TEXT,
-                sender_last_name TEXT,
-                text TEXT,
-                media_type TEXT,
-                sticker_emoji TEXT,
-                sticker_file_id TEXT,
-                sticker_set_name TEXT
+        print("Обновляю формат базы данных...")
+        # Колонки в SQLite надежно меняются только пересозданием таблицы; старые индексы
+        # удаляются вместе с ней, а create_indexes построит их заново
+        with self._transaction():
+            self.db_conn.execute("ALTER TABLE messages RENAME TO messages_old")
+            self.db_conn.execute(_CREATE_MESSAGES_SQL)
+            # strftime('%s') учитывает смещение часового пояса в ISO строке
+            self.db_conn.execute('''
+                INSERT INTO messages
+                SELECT id,
+                       CASE WHEN typeof(date) = 'text' THEN CAST(strftime('%s', date) AS INTEGER) ELSE date END,
+                       sender_id, text, media_type, sticker_emoji, sticker_file_id, sticker_set_name
+                FROM messages_old
+            ''')
+            # Для единственного агрегата MAX SQLite берет имена из той же строки,
+            # то есть из последнего сообщения участника
+            self.db_conn.execute('''
+                INSERT OR REPLACE INTO users
+                SELECT sender_id, sender_username, sender_first_name, sender_last_name, MAX(id)
+                FROM messages_old
+                WHERE sender_id IS NOT NULL
+                GROUP BY sender_id
+            ''')
+            self.db_conn.execute("DROP TABLE messages_old")
+        # Возвращаем место, освободившееся после удаления старой таблицы
+        self.db_conn.execute("VACUUM")
+
+    def _open_reader(self) -> sqlite3.Connection:
+        """Открывает отдельное соединение с базой только для чтения"""
+        return _connect_readonly(self.db_path, self.cache_size_mb)
+
+    async def run_analysis(self) -> Tuple[Dict, Dict[int, Dict]]:
+        """Считает глобальную и пользовательскую статистику параллельно на отдельных соединениях"""
+        loop = asyncio.get_running_loop()
+
+        def run(analyze):
+            conn = self._open_reader()
+            try:
+                return analyze(conn=conn)
+            finally:
+                conn.close()
+
+        # sqlite3 отпускает GIL на время выполнения запроса, поэтому запросы
+        # двух анализов действительно выполняются одновременно
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            global_stats, user_stats = await asyncio.gather(
+                loop.run_in_executor(pool, run, self.analyze_global_stats),
+                loop.run_in_executor(pool, run, self.analyze_users_stats),
             )
-        ''')
-
-        # Создаем индексы
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sender_id ON messages(sender_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_date ON messages(date)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_type ON messages(media_type)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sticker_file_id ON messages(sticker_file_id)')
-
-        self.db_conn.commit()
+        return global_stats, user_stats
+
+    def _stats_cache_key(self) -> tuple:
+        """Возвращает ключ кэша статистики: чат, период и состояние таблицы messages"""
+        max_id, count = self.db_conn.execute("SELECT MAX(id), COUNT(*) FROM messages").fetchone()
+        return (
+            self.chat_id,
+            self.start_date.date().isoformat() if self.start_date else "",
+            self.end_date.date().isoformat() if self.end_date else "",
+            max_id,
+            count,
+        )
 
-    def parse_date(self, date_str: str) -> datetime:
-        """Парсит дату в формате день.месяц.год и возвращает datetime с UTC временной зоной"""
+    def _load_cached_stats(self, key: tuple):
+        """Возвращает (global_stats, user_stats) из кэша или None, если данные изменились"""
+        row = self.db_conn.execute("""
+            SELECT payload FROM stats_cache
+            WHERE chat_id = ? AND start_date = ? AND end_date = ?
+                AND max_message_id IS ? AND message_count = ? AND version = ?
+        """, (*key, _STATS_CACHE_VERSION)).fetchone()
+        if not row:
+            return None
         try:
-            day, month, year = map(int, date_str.split('.'))
-            return datetime(year, month, day, tzinfo=timezone.utc)
-        except ValueError:
-            raise ValueError(f"Некорректный формат даты: {date_str}. Используйте формат: день.месяц.год")
+            global_stats, user_stats = json.loads(row[0])
+            # JSON хранит даты строками, а ключи словарей - только строками
+            for stats in (global_stats, *user_stats.values()):
+                day, count = stats["active_day"]
+                stats["active_day"] = (date.fromisoformat(day) if day else None, count)
+            return global_stats, {int(user_id): stats for user_id, stats in user_stats.items()}
+        except (ValueError, TypeError, KeyError):
+            return None  # Поврежденная запись - просто пересчитаем статистику
+
+    def _save_cached_stats(self, key: tuple, stats: tuple):
+        """Сохраняет статистику за период, заменяя прежний результат для этого периода
+
+        Записи, посчитанные по другому состоянию messages, больше не могут
+        совпасть с ключом и удаляются.
+        """
+        # Кортежи записываются списками, даты - строками ISO
+        payload = json.dumps(stats, ensure_ascii=False, default=date.isoformat)
+        with self._transaction():
+            self.db_conn.execute("""
+                DELETE FROM stats_cache
+                WHERE max_message_id IS NOT ? OR message_count != ? OR version != ?
+            """, (key[3], key[4], _STATS_CACHE_VERSION))
+            self.db_conn.execute(
+                "INSERT OR REPLACE INTO stats_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, _STATS_CACHE_VERSION, payload, time.time())
+            )
+
+    def create_indexes(self):
+        """Создает индексы для анализа (вызывается после загрузки сообщений)"""
+        # Построить индекс один раз по готовой таблице дешевле,
+        # чем обновлять несколько индексов на каждую вставку
+        cursor = self.db_conn.cursor()
+        # По дате фильтруются тексты; id для этого не подходит: у импортированной
+        # истории чата старые даты при новых id
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_date ON messages(date)')
+        # Покрывающий индекс для счетчиков по (участник, день): в нем есть все колонки
+        # этих запросов, поэтому SQLite не читает строки таблицы с текстами
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_sender_activity ON messages(sender_id, date, media_type, sticker_emoji)')
+        # Частичные покрывающие индексы только по стикерам - они в разы меньше таблицы
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_stickers ON messages(sticker_emoji, sticker_set_name, date)
+            WHERE sticker_emoji IS NOT NULL
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_sender_stickers ON messages(sender_id, sticker_emoji, sticker_set_name, date)
+            WHERE sticker_emoji IS NOT NULL
+        ''')
+        # Индексы, которые покрываются индексами выше или не используются запросами анализа
+        for index in ('idx_sender_id', 'idx_sender_media', 'idx_media_type', 'idx_sender_sticker'):
+            cursor.execute(f'DROP INDEX IF EXISTS {index}')
+        # По sticker_file_id запросов нет, индекс только замедлял загрузку
+        cursor.execute('DROP INDEX IF EXISTS idx_sticker_file_id')
+        # Статистика по выборке строк (доли секунды): без нее планировщик для запросов
+        # с периодом выбирает idx_date вместо покрывающих индексов
+        cursor.execute('PRAGMA analysis_limit=1000')
+        cursor.execute('ANALYZE')
 
     async def fetch_messages(self):
         """Собирает все сообщения из выбранного чата"""
         print("Начинаю загрузку сообщений...")
 
-        # Проверяем доступ к чату
-        try:
-            chat = await self.client.get_chat(self.chat_id)
-        except Exception as e:
-            print(f"Ошибка при получении информации о чате: {e}")
-            return
+        # Проверяем доступ к чату, если это не сделано раньше
+        if self._chat is None or self._chat.id != self.chat_id:
+            try:
+                self._chat = await self.client.get_chat(self.chat_id)
+            except Exception as e:
+                print(f"Ошибка при получении информации о чате: {e}")
+                return
 
         count = 0
-        batch_count = 0
-        batch_size = 100  # Размер батча для коммита в БД
+        batch_size = 1000  # Размер батча для вставки в БД
 
-        try:
-            async for message in self.client.get_chat_history(self.chat_id):
-                # В Pyrogram 2.x+ message.date уже является объектом datetime с часовым поясом
-                message_date = message.date
-
-                # Приводим к UTC если необходимо
-                if message_date.tzinfo is None:
-                    message_date = message_date.replace(tzinfo=timezone.utc)
-                else:
-                    message_date = message_date.astimezone(timezone.utc)
+        # Загрузка из Telegram и запись в БД идут параллельно: сообщения складываются
+        # в очередь, а отдельная задача пишет их в базу пачками
+        queue = asyncio.Queue(maxsize=4096)
+        writer = asyncio.create_task(self._write_rows(queue, batch_size))
 
-                # Если указан период, проверяем вхождение в диапазон
-                if self.start_date and message_date < self.start_date:
-                    continue  # Пропускаем сообщения до начала периода
-                if self.end_date and message_date > self.end_date:
-                    continue  # Пропускаем сообщения после окончания периода
+        # При заданном периоде запрашиваем историю сразу с конца периода (включая весь
+        # последний день, как и _get_date_filter_query). На первом сообщении до начала
+        # периода загрузку не прекращаем: история идет по id, а у импортированной
+        # истории чата старые даты при новых id, и дальше могут быть сообщения периода
+        end_bound = self.end_date + timedelta(days=1) if self.end_date else None
 
-                self._save_message(message)
-                count += 1
-                batch_count += 1
+        # Ограничение скорости задает сам Telegram через FloodWait: после паузы
+        # продолжаем загрузку с последнего полученного сообщения
+        offset_id = 0
 
-                if batch_count >= batch_size:
-                    print(f"Загружено {count} сообщений...")
-                    self.db_conn.commit()  # Регулярно сохраняем данные
-                    batch_count = 0
-
-                    # Делаем небольшую паузу для избежания флуд-ограничений
-                    await asyncio.sleep(0.1)
-
-            # Финальный коммит
-            self.db_conn.commit()
-            print(f"Всего загружено {count} сообщений")
+        try:
+            while True:
+                if offset_id:
+                    history = self.client.get_chat_history(self.chat_id, offset_id=offset_id)
+                elif end_bound:
+                    history = self.client.get_chat_history(self.chat_id, offset_date=end_bound)
+                else:
+                    history = self.client.get_chat_history(self.chat_id)
+
+                try:
+                    async for message in history:
+                        offset_id = message.id
+
+                        # Pyrogram 2 отдает message.date как наивное локальное время
+                        # (datetime.fromtimestamp); astimezone переводит в UTC и наивную,
+                        # и уже снабженную часовым поясом дату
+                        message_date = message.date.astimezone(timezone.utc)
+
+                        # Если указан период, проверяем вхождение в диапазон
+                        if self.start_date and message_date < self.start_date:
+                            continue  # Пропускаем сообщения до начала периода
+                        if end_bound and message_date >= end_bound:
+                            continue  # Пропускаем сообщения после окончания периода
+
+                        await queue.put((self._message_row(message, message_date), self._user_row(message)))
+                        count += 1
+                    break
+                except FloodWait as e:
+                    print(f"Получен FloodWait: ждем {e.value} секунд")
+                    await asyncio.sleep(e.value)
 
-        except FloodWait as e:
-            print(f"Получен FloodWait: ждем {e.x} секунд")
-            await asyncio.sleep(e.x)
         except Exception as e:
             print(f"Ошибка при загрузке сообщений: {e}")
             import traceback
             traceback.print_exc()
+        finally:
+            # Дожидаемся записи оставшихся строк, в том числе при прерывании загрузки
+            await queue.put(None)
+            await writer
+
+        print(f"Всего загружено {count} сообщений")
 
+    async def _write_rows(self, queue: asyncio.Queue, batch_size: int, flush_interval: float = 1.0):
+        """Забирает строки из очереди и пишет их в БД пачками вне цикла событий
+
+        Неполная пачка записывается, если новых строк нет дольше flush_interval
+        секунд (например, во время ожидания FloodWait).
+        """
+        buf = []
+        saved = 0
+
+        async def flush():
+            nonlocal buf, saved
+            try:
+                # Пишем в потоке, чтобы SQLite не блокировал цикл событий
+                await asyncio.to_thread(self._insert_rows, buf)
+                saved += len(buf)
+                print(f"Загружено {saved} сообщений...")
+            except Exception as e:
+                # Продолжаем разбирать очередь, чтобы не блокировать загрузку
+                print(f"Ошибка при сохранении сообщений: {e}")
+            buf = []
+
+        while True:
+            try:
+                # Пока есть неполная пачка, ждем новую строку не дольше flush_interval
+                row = await asyncio.wait_for(queue.get(), flush_interval if buf else None)
+            except asyncio.TimeoutError:
+                await flush()
+                continue
+            if row is None:
+                if buf:
+                    await flush()
+                break
+            buf.append(row)
+            if len(buf) >= batch_size:
+                await flush()
+
+    def _insert_rows(self, rows: List[tuple]):
+        """Вставляет пачку пар (строка messages, строка users или None) одной транзакцией"""
+        # В пачке у участника много сообщений, а имена нужны только из самого нового
+        users = {}
+        for _, user in rows:
+            if user and (user[0] not in users or user[4] > users[user[0]][4]):
+                users[user[0]] = user
 
-    def _save_message(self, message: Message):
-        """Сохраняет сообщение в базу данных"""
         cursor = self.db_conn.cursor()
+        with self._transaction():
+            cursor.executemany(_INSERT_MESSAGE_SQL, (message_row for message_row, _ in rows))
+            cursor.executemany(_UPSERT_USER_SQL, users.values())
+
+    def _message_row(self, message: Message, message_date: datetime) -> tuple:
+        """Преобразует сообщение (с уже приведенной к UTC датой) в строку таблицы messages"""
         text = message.text or message.caption
 
         # Определение типа медиа
@@ -164,248 +583,180 @@ class ChatAnalyzer:
             media_type = "video_note"
             file_id = message.video_note.file_id
 
-        # В Pyrogram 2.x+ message.date уже является объектом datetime
-        # Приводим к UTC и преобразуем в ISO формат
-        message_date = message.date.astimezone(timezone.utc).isoformat()
-
-        cursor.execute(
-            "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (
-                message.id,
-                message_date,  # Используем преобразованную дату
-                message.from_user.id if message.from_user else None,
-                message.from_user.username if message.from_user else None,
-                message.from_user.first_name if message.from_user else None,
-                message.from_user.last_name if message.from_user else None,
-                text,
-                media_type,
-                emoji,
-                file_id,
-                set_name
-            )
+        return (
+            message.id,
+            int(message_date.timestamp()),  # Секунды Unix, дата приведена к UTC в fetch_messages
+            message.from_user.id if message.from_user else None,
+            text,
+            media_type,
+            emoji,
+            file_id,
+            set_name
         )
 
-    def analyze_global_stats(self) -> Dict:
-        """Анализирует глобальную статистику чата"""
-        cursor = self.db_conn.cursor()
+    @staticmethod
+    def _user_row(message: Message):
+        """Возвращает строку таблицы users для отправителя сообщения (или None)"""
+        user = message.from_user
+        if not user:
+            return None
+        return user.id, user.username, user.first_name, user.last_name, message.id
+
+    @staticmethod
+    def _top_sender_by(sender_counts: List[tuple], column: int, names: Dict[int, str]):
+        """Возвращает (sender_id, имя, количество) участника с максимумом в колонке или None"""
+        best = max(sender_counts, key=lambda row: row[column], default=None)
+        if not best or not best[column]:
+            return None
+        return best[0], names.get(best[0]), best[column]
+
+    @staticmethod
+    def _day_stats(day_counts: List[Tuple[int, int]]) -> Tuple[tuple, int]:
+        """По списку (номер дня, количество), упорядоченному по дню, возвращает самый активный день и число дней без активности"""
+        if not day_counts:
+            return (None, 0), 0
+        day, count = max(day_counts, key=lambda x: x[1])
+        total_days = day_counts[-1][0] - day_counts[0][0] + 1
+        return (_day_date(day), count), total_days - len(day_counts)
+
+    @staticmethod
+    def _top_stickers(rows, limit: int) -> List[tuple]:
+        """Сворачивает строки (эмодзи, стикерпак, количество) по эмодзи
+
+        Возвращает топ эмодзи в виде (эмодзи, количество, стикерпак, ссылка),
+        где стикерпак - самый частый для этого эмодзи.
+        """
+        totals = Counter()
+        best_sets = {}
+        for emoji, set_name, count in rows:
+            if not emoji:
+                continue
+            totals[emoji] += count
+            if emoji not in best_sets or count > best_sets[emoji][1]:
+                best_sets[emoji] = (set_name, count)
+
+        top_stickers = []
+        for emoji, count in totals.most_common(limit):
+            set_name = best_sets[emoji][0]
+            top_stickers.append((emoji, count, set_name, _pack_link(set_name)))
+        return top_stickers
+
+    def analyze_global_stats(self, conn: sqlite3.Connection = None) -> Dict:
+        """Анализирует глобальную статистику чата (на переданном соединении или основном)
 
-        # 1. Всего сообщений (с фильтрацией по периоду)
-        query = "SELECT COUNT(*) FROM messages WHERE 1=1"
+        Таблица читается тремя проходами: счетчики по участникам и дням, стикеры
+        и тексты. Все остальные метрики выводятся из них в Python.
+        """
+        cursor = (conn or self.db_conn).cursor()
+
+        # Счетчики по (участник, день) с фильтрацией по периоду - из них получаются п. 1, 4-9, 11, 12 и 14.
+        # Результат в разы меньше таблицы: по строке на каждый день активности каждого участника.
+        # Даты хранятся в секундах Unix (UTC), поэтому номер дня - это целочисленное деление на 86400
+        query = """
+            SELECT sender_id, date / 86400 AS day,
+                   COUNT(*),
+                   SUM(CASE WHEN IFNULL(media_type, '') NOT IN ('photo', 'video') THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN media_type IN ('voice', 'video_note') THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN media_type IN ('photo', 'video') THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN sticker_emoji IS NOT NULL THEN 1 ELSE 0 END)
+            FROM messages
+            WHERE 1=1
+        """
         query, params = self._get_date_filter_query(query)
-        cursor.execute(query, params)
-        total_messages = cursor.fetchone()[0]
+        query += " GROUP BY sender_id, day"
+
+        total_messages = 0
+        voice_count = 0
+        day_activity = Counter()
+        month_activity = Counter()
+        month_senders = defaultdict(Counter)
+        sender_totals = defaultdict(lambda: [0, 0, 0, 0])  # сообщения, голосовые, фото/видео, стикеры
+        for sender_id, day, count, non_media, voice, media, stickers in cursor.execute(query, params):
+            total_messages += count
+            voice_count += voice
+            if day is not None:
+                month = _day_month(day)
+                if non_media:
+                    day_activity[day] += non_media
+                month_activity[month] += count
+                if sender_id is not None:
+                    month_senders[month][sender_id] += count
+            if sender_id is not None:
+                totals = sender_totals[sender_id]
+                totals[0] += count
+                totals[1] += voice
+                totals[2] += media
+                totals[3] += stickers
+
+        # Имена участников (из их последних загруженных сообщений)
+        names = dict(cursor.execute("SELECT id, first_name FROM users"))
+
+        # 1. Всего сообщений (с фильтрацией по периоду) - посчитано выше
 
         # 2. Топ-10 самых популярных слов (с фильтрацией по периоду)
-        query = "SELECT text FROM messages WHERE text IS NOT NULL"
+        # Тексты читаются и разбиваются на слова один раз: здесь же считаются
+        # слова по участникам (п. 10) и по месяцам (п. 13)
+        query = "SELECT date / 86400, sender_id, text FROM messages WHERE text IS NOT NULL"
         query, params = self._get_date_filter_query(query)
-        cursor.execute(query, params)
-        all_texts = [row[0] for row in cursor.fetchall()]
-        words = []
-        stop_words = {
-            'и', 'в', 'на', 'с', 'по', 'за', 'до', 'о', 'у', 'а', 'но', 'или', 'же',
-            'то', 'не', 'что', 'как', 'это', 'бы', 'был', 'была', 'было', 'так', 'вот',
-            'же', 'ли', 'же', 'же', 'же', 'же', 'же', 'же', 'же', 'же', 'же', 'же',
-            'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of',
-            'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have', 'has', 'had',
-            'will', 'would', 'could', 'should', 'may', 'might', 'can', 'this', 'that', 'these', 'those'
-        }
-
-        for text in all_texts:
+        words_counter = Counter()
+        word_counts = Counter()
+        month_words = defaultdict(Counter)
+        # Итерируемся по курсору, не загружая все тексты в память
+        for day, user_id, text in cursor.execute(query, params):
             if text:
                 # Извлекаем слова длиной >= 2 и не входящие в стоп-слова
-                text_words = re.findall(r'\b\w{2,}\b', text.lower())
-                words.extend([word for word in text_words if word not in stop_words])
+                text_words = _text_words(text)
+                words_counter.update(text_words)
+                month_words[_day_month(day) if day is not None else None].update(text_words)
+                if user_id:
+                    word_counts[user_id] += len(text_words)
 
-        top_words = Counter(words).most_common(10)
+        top_words = words_counter.most_common(10)
 
         # 3. Топ-5 самых популярных стикеров (по эмодзи, а не file_id) с фильтрацией по периоду
-        query = "SELECT sticker_emoji, sticker_set_name FROM messages WHERE sticker_emoji IS NOT NULL"
-        query, params = self._get_date_filter_query(query)
-        cursor.execute(query, params)
-        sticker_data = [(row[0], row[1]) for row in cursor.fetchall() if row[0]]
-        sticker_emojis = [row[0] for row in sticker_data]
-        top_stickers = Counter(sticker_emojis).most_common(5)
-
-        # Получаем дополнительную информацию о топ-стикерах
-        detailed_top_stickers = []
-        for emoji, count in top_stickers:
-            # Получаем имя стикерпака для этого эмодзи (с фильтрацией по периоду)
-            query = "SELECT sticker_set_name FROM messages WHERE sticker_emoji = ?"
-            query, params = self._get_date_filter_query(query)
-            query += "LIMIT 1"
-            params = [emoji] + params
-            cursor.execute(query, params)
-            result = cursor.fetchone()
-            if result and result[0]:
-                set_name = result[0]
-                sticker_pack_link = f"tg://addstickers?set={set_name}"
-            else:
-                set_name = None
-                sticker_pack_link = None
-            detailed_top_stickers.append((emoji, count, set_name, sticker_pack_link))
-
-        # 4. Самый активный день (учитываем только текстовые сообщения, без фото и видео) с фильтрацией
-        query = "SELECT date FROM messages WHERE date IS NOT NULL AND media_type NOT IN ('photo', 'video')"
+        # Стикерпак получаем в том же запросе, без отдельного запроса на каждый эмодзи
+        query = "SELECT sticker_emoji, sticker_set_name, COUNT(*) FROM messages WHERE sticker_emoji IS NOT NULL"
         query, params = self._get_date_filter_query(query)
-        cursor.execute(query, params)
-        # ИСПРАВЛЕНО: теперь правильно парсим дату из ISO строки
-        date_strings = [row[0] for row in cursor.fetchall()]
-        dates = []
-        for dt_str in date_strings:
-            try:
-                dt = datetime.fromisoformat(dt_str).astimezone(timezone.utc)
-                dates.append(dt.date())
-            except ValueError:
-                # Пропускаем некорректные строки дат
-                continue
-        active_day = Counter(dates).most_common(1)[0] if dates else (None, 0)
+        query += " GROUP BY sticker_emoji, sticker_set_name ORDER BY COUNT(*) DESC"
+        detailed_top_stickers = self._top_stickers(cursor.execute(query, params), 5)
 
+        # 4. Самый активный день (учитываем только текстовые сообщения, без фото и видео)
         # 5. Дней без активности (учитываем весь период от первого до последнего сообщения)
-        if dates:
-            start_date = min(dates)
-            end_date = max(dates)
-            total_days = (end_date - start_date).days + 1
-            active_days = len(set(dates))
-            inactive_days = total_days - active_days
-        else:
-            inactive_days = 0
+        active_day, inactive_days = self._day_stats(sorted(day_activity.items()))
 
-        # 6. Общее количество голосовых/кружочков с фильтрацией
-        query = "SELECT COUNT(*) FROM messages WHERE media_type IN ('voice', 'video_note')"
-        query, params = self._get_date_filter_query(query)
-        cursor.execute(query, params)
-        voice_count = cursor.fetchone()[0]
+        # 6. Общее количество голосовых/кружочков - посчитано выше
 
-        # 7. Самый активный участник по сообщениям (по ID, а не по имени) с фильтрацией
-        query = """
-            SELECT sender_id, sender_first_name, COUNT(*) 
-            FROM messages 
-            WHERE sender_id IS NOT NULL
-        """
-        query, params = self._get_date_filter_query(query)
-        query += " GROUP BY sender_id ORDER BY COUNT(*) DESC LIMIT 1"
-        cursor.execute(query, params)
-        top_sender = cursor.fetchone()
+        # 7, 8, 9, 11. Самые активные участники по сообщениям, голосовым, фото/видео и стикерам (по ID)
+        sender_counts = [(sender_id, *totals) for sender_id, totals in sorted(sender_totals.items())]
+        top_sender = self._top_sender_by(sender_counts, 1, names)
+        top_voice_sender = self._top_sender_by(sender_counts, 2, names)
+        top_media_sender = self._top_sender_by(sender_counts, 3, names)
+        top_sticker_sender = self._top_sender_by(sender_counts, 4, names)
 
-        # 8. Самый активный по голосовым (по ID) с фильтрацией
-        query = """
-            SELECT sender_id, sender_first_name, COUNT(*) 
-            FROM messages 
-            WHERE sender_id IS NOT NULL AND media_type IN ('voice', 'video_note')
-        """
-        query, params = self._get_date_filter_query(query)
-        query += " GROUP BY sender_id ORDER BY COUNT(*) DESC LIMIT 1"
-        cursor.execute(query, params)
-        top_voice_sender = cursor.fetchone()
-
-        # 9. Самый активный по фото/видео (по ID) с фильтрацией
-        query = """
-            SELECT sender_id, sender_first_name, COUNT(*) 
-            FROM messages 
-            WHERE sender_id IS NOT NULL AND media_type IN ('photo', 'video')
-        """
-        query, params = self._get_date_filter_query(query)
-        query += " GROUP BY sender_id ORDER BY COUNT(*) DESC LIMIT 1"
-        cursor.execute(query, params)
-        top_media_sender = cursor.fetchone()
-
-        # 10. Самый активный по словам (по ID) с фильтрацией
-        word_counts = defaultdict(int)
-        query = "SELECT text, sender_id FROM messages WHERE text IS NOT NULL AND sender_id IS NOT NULL"
-        query, params = self._get_date_filter_query(query)
-        cursor.execute(query, params)
-
-        for text, user_id in cursor.fetchall():
-            if user_id and text:
-                # Учитываем только слова длиной >= 2 и не входящие в стоп-слова
-                text_words = re.findall(r'\b\w{2,}\b', text.lower())
-                filtered_words = [word for word in text_words if word not in stop_words]
-                word_counts[user_id] += len(filtered_words)
+        # 10. Самый активный по словам (по ID) с фильтрацией - слова посчитаны в п. 2
         top_wordy_sender = max(word_counts.items(), key=lambda x: x[1]) if word_counts else (None, 0)
 
-        # 11. Самый активный по стикерам (по ID) с фильтрацией
-        query = """
-            SELECT sender_id, sender_first_name, COUNT(*) 
-            FROM messages 
-            WHERE sender_id IS NOT NULL AND sticker_emoji IS NOT NULL
-        """
-        query, params = self._get_date_filter_query(query)
-        query += " GROUP BY sender_id ORDER BY COUNT(*) DESC LIMIT 1"
-        cursor.execute(query, params)
-        top_sticker_sender = cursor.fetchone()
-
-        # 12. Месяцы по активности (с фильтрацией по периоду)
-        month_activity = defaultdict(int)
-        query = "SELECT date FROM messages WHERE date IS NOT NULL"
-        query, params = self._get_date_filter_query(query)
-        cursor.execute(query, params)
-
-        # ИСПРАВЛЕНО: теперь правильно парсим дату из ISO строки
-        date_strings = [row[0] for row in cursor.fetchall()]
-        for dt_str in date_strings:
-            try:
-                dt = datetime.fromisoformat(dt_str).astimezone(timezone.utc)
-                month = dt.strftime('%Y-%m')
-                month_activity[month] += 1
-            except ValueError:
-                # Пропускаем некорректные строки дат
-                continue
+        # 12. Месяцы по активности (с фильтрацией по периоду), при равенстве - в хронологическом порядке
+        month_activity = dict(sorted(month_activity.items()))
         monthly_ranking = sorted(month_activity.items(), key=lambda x: x[1], reverse=True)
 
         # 13. Популярные слова по месяцам (только для месяцев в выбранном периоде)
-        monthly_top_words = {}
-        for month in month_activity.keys():
-            # Вычисляем диапазон дат для месяца
-            year, mon = map(int, month.split('-'))
-            month_start = datetime(year, mon, 1, tzinfo=timezone.utc).isoformat()
+        # Слова по месяцам разложены в п. 2
+        monthly_top_words = {
+            month: month_words[month].most_common(1)[0][0]
+            for month in month_activity.keys()
+            if month_words[month]
+        }
 
-            # Следующий месяц
-            if mon == 12:
-                next_month_start = datetime(year + 1, 1, 1, tzinfo=timezone.utc).isoformat()
-            else:
-                next_month_start = datetime(year, mon + 1, 1, tzinfo=timezone.utc).isoformat()
-
-            # Запрос с фильтрацией по периоду И по месяцу
-            base_query = """
-                SELECT text FROM messages 
-                WHERE date >= ? AND date < ?
-            """
-            query, params = self._get_date_filter_query(base_query)
-            params = [month_start, next_month_start] + params
-
-            cursor.execute(query, params)
-            texts = [row[0] for row in cursor.fetchall() if row[0]]
-            all_month_words = []
-            for text in texts:
-                if text:
-                    # Учитываем только слова длиной >= 2 и не входящие в стоп-слова
-                    text_words = re.findall(r'\b\w{2,}\b', text.lower())
-                    filtered_words = [word for word in text_words if word not in stop_words]
-                    all_month_words.extend(filtered_words)
-            if all_month_words:
-                monthly_top_words[month] = Counter(all_month_words).most_common(1)[0][0]
-
-        # 14. Самые активные участники по месяцам (с фильтрацией)
+        # 14. Самые активные участники по месяцам (при равенстве - с меньшим ID)
         monthly_top_senders = {}
         for month in month_activity.keys():
-            year, mon = map(int, month.split('-'))
-            month_start = datetime(year, mon, 1, tzinfo=timezone.utc).isoformat()
-
-            if mon == 12:
-                next_month_start = datetime(year + 1, 1, 1, tzinfo=timezone.utc).isoformat()
+            senders = sorted(month_senders[month].items())
+            if senders:
+                sender_id = max(senders, key=lambda x: x[1])[0]
+                monthly_top_senders[month] = (names.get(sender_id), sender_id)  # (имя, id)
             else:
-                next_month_start = datetime(year, mon + 1, 1, tzinfo=timezone.utc).isoformat()
-
-            base_query = """
-                SELECT sender_id, sender_first_name, COUNT(*) FROM messages 
-                WHERE date >= ? AND date < ? AND sender_id IS NOT NULL
-            """
-            query, params = self._get_date_filter_query(base_query)
-            query+="GROUP BY sender_id ORDER BY COUNT(*) DESC LIMIT 1"
-            params = [month_start, next_month_start] + params
-            cursor.execute(query, params)
-            result = cursor.fetchone()
-            monthly_top_senders[month] = (result[1] if result else None, result[0] if result else None)  # (имя, id)
+                monthly_top_senders[month] = (None, None)
 
         return {
             "total_messages": total_messages,
@@ -424,247 +775,285 @@ class ChatAnalyzer:
             "monthly_top_senders": monthly_top_senders
         }
 
-    def analyze_user_stats(self, user_id: int) -> Dict:
-        """Анализирует статистику конкретного пользователя"""
-        cursor = self.db_conn.cursor()
+    def analyze_users_stats(self, user_id: int = None, conn: sqlite3.Connection = None) -> Dict[int, Dict]:
+        """Анализирует статистику всех пользователей (или одного, если указан user_id)
 
-        # 1. Всего сообщений (с фильтрацией по периоду)
-        query = "SELECT COUNT(*) FROM messages WHERE sender_id = ?"
-        params = [user_id]
-        query, date_params = self._get_date_filter_query(query)
-        params = params + date_params
-        cursor.execute(query, params)
-        total_messages = cursor.fetchone()[0]
-
-        # 2. Топ-10 слов (с фильтрацией по периоду)
-        query = "SELECT text FROM messages WHERE sender_id = ? AND text IS NOT NULL"
-        params = [user_id]
-        query, date_params = self._get_date_filter_query(query)
-        params = params + date_params
-        cursor.execute(query, params)
-        user_texts = [row[0] for row in cursor.fetchall() if row[0]]
-        all_user_words = []
-        stop_words = {
-            'и', 'в', 'на', 'с', 'по', 'за', 'до', 'о', 'у', 'а', 'но', 'или', 'же',
-            'то', 'не', 'что', 'как', 'это', 'бы', 'был', 'была', 'было', 'так', 'вот',
-            'же', 'ли', 'же', 'же', 'же', 'же', 'же', 'же', 'же', 'же', 'же', 'же',
-            'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of',
-            'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have', 'has', 'had',
-            'will', 'would', 'could', 'should', 'may', 'might', 'can', 'this', 'that', 'these', 'those'
-        }
+        Счетчики по дням, месяцам и типам сообщений группирует SQLite, а в Python
+        обрабатываются только тексты - их нужно разбить на слова.
+        """
+        cursor = (conn or self.db_conn).cursor()
 
-        for text in user_texts:
-            if text:
-                # Учитываем только слова длиной >= 2 и не входящие в стоп-слова
-                text_words = re.findall(r'\b\w{2,}\b', text.lower())
-                filtered_words = [word for word in text_words if word not in stop_words]
-                all_user_words.extend(filtered_words)
-        top_user_words = Counter(all_user_words).most_common(10)
-
-        # 3. Самый популярный стикер (по эмодзи, а не file_id) с фильтрацией
-        query = "SELECT sticker_emoji, sticker_set_name FROM messages WHERE sender_id = ? AND sticker_emoji IS NOT NULL"
-        params = [user_id]
-        query, date_params = self._get_date_filter_query(query)
-        params = params + date_params
-        cursor.execute(query, params)
-        user_sticker_data = [(row[0], row[1]) for row in cursor.fetchall() if row[0]]
-        user_stickers = [row[0] for row in user_sticker_data]
-        if user_stickers:
-            top_user_sticker_emoji = Counter(user_stickers).most_common(1)[0]
-            # Получаем имя стикерпака для этого эмодзи (с фильтрацией)
-            query = "SELECT sticker_set_name FROM messages WHERE sender_id = ? AND sticker_emoji = ?"
-            params = [user_id, top_user_sticker_emoji[0]]
+        def filtered(query: str) -> Tuple[str, list]:
+            params = []
+            if user_id is not None:
+                query += " AND sender_id = ?"
+                params.append(user_id)
             query, date_params = self._get_date_filter_query(query)
-            params = params + date_params
-            cursor.execute(query, params)
-            result = cursor.fetchone()
-            if result and result[0]:
-                set_name = result[0]
-                sticker_pack_link = f"tg://addstickers?set={set_name}"
-            else:
-                set_name = None
-                sticker_pack_link = None
-            top_user_sticker = (top_user_sticker_emoji[0], top_user_sticker_emoji[1], set_name, sticker_pack_link)
-        else:
-            top_user_sticker = (None, 0, None, None)
-
-        # 4. Самый активный день (учитываем только текстовые сообщения, без фото и видео) с фильтрацией
-        query = "SELECT date FROM messages WHERE sender_id = ? AND date IS NOT NULL AND media_type NOT IN ('photo', 'video')"
-        params = [user_id]
-        query, date_params = self._get_date_filter_query(query)
-        params = params + date_params
-        cursor.execute(query, params)
-        # ИСПРАВЛЕНО: теперь правильно парсим дату из ISO строки
-        date_strings = [row[0] for row in cursor.fetchall()]
-        user_dates = []
-        for dt_str in date_strings:
-            try:
-                dt = datetime.fromisoformat(dt_str).astimezone(timezone.utc)
-                user_dates.append(dt.date())
-            except ValueError:
-                # Пропускаем некорректные строки дат
-                continue
-        active_user_day = Counter(user_dates).most_common(1)[0] if user_dates else (None, 0)
-
-        # 5. Дней без активности (в рамках общего периода)
-        if user_dates:
-            start_date = min(user_dates)
-            end_date = max(user_dates)
-            total_days = (end_date - start_date).days + 1
-            active_days = len(set(user_dates))
-            inactive_days = total_days - active_days
+            return query, params + date_params
+
+        # Накопители по каждому пользователю
+        users = defaultdict(lambda: {
+            "total_messages": 0,
+            "words": Counter(),
+            "stickers": Counter(),  # (эмодзи, стикерпак) -> количество
+            "days": Counter(),
+            "voice_count": 0,
+            "months": Counter(),
+        })
+
+        # Сообщения по пользователям и дням (номер дня - секунды Unix, деленные на 86400)
+        query, params = filtered("""
+            SELECT sender_id, date / 86400 AS day, COUNT(*),
+                   SUM(CASE WHEN IFNULL(media_type, '') NOT IN ('photo', 'video') THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN media_type IN ('voice', 'video_note') THEN 1 ELSE 0 END)
+            FROM messages
+            WHERE sender_id IS NOT NULL
+        """)
+        query += " GROUP BY sender_id, day"
+        for sender_id, day, count, non_media_count, voice_count in cursor.execute(query, params):
+            acc = users[sender_id]
+            acc["total_messages"] += count
+            acc["voice_count"] += voice_count
+            if day is not None:
+                if non_media_count:
+                    acc["days"][day] = non_media_count
+                acc["months"][_day_month(day)] += count
+
+        # Стикеры по пользователям
+        query, params = filtered("""
+            SELECT sender_id, sticker_emoji, sticker_set_name, COUNT(*)
+            FROM messages
+            WHERE sender_id IS NOT NULL AND sticker_emoji IS NOT NULL
+        """)
+        query += " GROUP BY sender_id, sticker_emoji, sticker_set_name"
+        for sender_id, emoji, set_name, count in cursor.execute(query, params):
+            users[sender_id]["stickers"][(emoji, set_name)] = count
+
+        # Слова по пользователям (только длиной >= 2 и не входящие в стоп-слова)
+        query, params = filtered("SELECT sender_id, text FROM messages WHERE sender_id IS NOT NULL AND text IS NOT NULL")
+        total_messages = sum(acc["total_messages"] for acc in users.values())
+        workers = min(os.cpu_count() or 1, _MAX_WORD_WORKERS, len(users))
+        if user_id is None and workers > 1 and total_messages >= _PARALLEL_MIN_MESSAGES:
+            # Разбор текстов упирается в GIL, поэтому делим пользователей между процессами.
+            # Каждый пользователь целиком попадает в один процесс, и его тексты
+            # читаются в том же порядке, что и без распараллеливания
+            shard_query = query + " AND sender_id % ? = ?"
+            # spawn: fork из процесса с потоками (анализ выполняется в потоке) небезопасен
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                shards = pool.map(
+                    _count_words_by_sender,
+                    [self.db_path] * workers,
+                    [shard_query] * workers,
+                    [params + [workers, shard] for shard in range(workers)],
+                )
+                for shard_words in shards:
+                    for sender_id, words in shard_words.items():
+                        users[sender_id]["words"] = words
         else:
-            inactive_days = 0
-
-        # 6. Количество голосовых с фильтрацией
-        query = "SELECT COUNT(*) FROM messages WHERE sender_id = ? AND media_type IN ('voice', 'video_note')"
-        params = [user_id]
-        query, date_params = self._get_date_filter_query(query)
-        params = params + date_params
-        cursor.execute(query, params)
-        user_voice_count = cursor.fetchone()[0]
-
-        # 7. Месяцы по активности (с фильтрацией)
-        user_month_activity = defaultdict(int)
-        query = "SELECT date FROM messages WHERE sender_id = ? AND date IS NOT NULL"
-        params = [user_id]
-        query, date_params = self._get_date_filter_query(query)
-        params = params + date_params
-        cursor.execute(query, params)
-
-        # ИСПРАВЛЕНО: теперь правильно парсим дату из ISO строки
-        date_strings = [row[0] for row in cursor.fetchall()]
-        for dt_str in date_strings:
-            try:
-                dt = datetime.fromisoformat(dt_str).astimezone(timezone.utc)
-                month = dt.strftime('%Y-%m')
-                user_month_activity[month] += 1
-            except ValueError:
-                # Пропускаем некорректные строки дат
-                continue
-        user_monthly_ranking = sorted(user_month_activity.items(), key=lambda x: x[1], reverse=True)
+            for sender_id, text in cursor.execute(query, params):
+                if text:
+                    users[sender_id]["words"].update(_text_words(text))
 
+        user_stats = {}
+        for sender_id in sorted(users):
+            acc = users[sender_id]
+            user_top_stickers = self._top_stickers(
+                ((emoji, set_name, count) for (emoji, set_name), count in acc["stickers"].items()), 1)
+            active_user_day, inactive_days = self._day_stats(sorted(acc["days"].items()))
+            user_stats[sender_id] = {
+                "total_messages": acc["total_messages"],
+                "top_words": acc["words"].most_common(10),
+                "top_sticker": user_top_stickers[0] if user_top_stickers else (None, 0, None, None),
+                "active_day": active_user_day,
+                "inactive_days": inactive_days,
+                "voice_count": acc["voice_count"],
+                # Месяцы по активности, при равенстве - в хронологическом порядке
+                "monthly_ranking": sorted(acc["months"].items(), key=lambda x: (-x[1], x[0]))
+            }
+        return user_stats
+
+    def analyze_user_stats(self, user_id: int) -> Dict:
+        """Анализирует статистику конкретного пользователя"""
+        user_stats = self.analyze_users_stats(user_id)
+        if user_id in user_stats:
+            return user_stats[user_id]
         return {
-            "total_messages": total_messages,
-            "top_words": top_user_words,
-            "top_sticker": top_user_sticker,
-            "active_day": active_user_day,
-            "inactive_days": inactive_days,
-            "voice_count": user_voice_count,
-            "monthly_ranking": user_monthly_ranking
+            "total_messages": 0,
+            "top_words": [],
+            "top_sticker": (None, 0, None, None),
+            "active_day": (None, 0),
+            "inactive_days": 0,
+            "voice_count": 0,
+            "monthly_ranking": []
         }
+
     def export_results(self, global_stats: Dict, user_stats: Dict[str, Dict], output_file: str):
         """Экспортирует результаты в текстовый файл"""
-        with open(output_file, 'w', encoding='utf-8') as f:
-            # Добавляем информацию о периоде анализа
-            if self.start_date and self.end_date:
-                start_str = self.start_date.strftime("%d.%m.%Y")
-                end_str = self.end_date.strftime("%d.%m.%Y")
-                f.write(f"=== АНАЛИЗ ЗА ПЕРИОД: {start_str} - {end_str} ===\n\n")
-            elif self.start_date:
-                start_str = self.start_date.strftime("%d.%m.%Y")
-                f.write(f"=== АНАЛИЗ С {start_str} ===\n\n")
-            elif self.end_date:
-                end_str = self.end_date.strftime("%d.%m.%Y")
-                f.write(f"=== АНАЛИЗ ДО {end_str} ===\n\n")
-            else:
-                f.write("=== АНАЛИЗ ЗА ВСЕ ВРЕМЯ ===\n\n")
+        # Собираем отчет в список строк и записываем в файл одним вызовом
+        out = []
+        # Добавляем информацию о периоде анализа
+        if self.start_date and self.end_date:
+            start_str = self.start_date.strftime("%d.%m.%Y")
+            end_str = self.end_date.strftime("%d.%m.%Y")
+            out.append(f"=== АНАЛИЗ ЗА ПЕРИОД: {start_str} - {end_str} ===\n\n")
+        elif self.start_date:
+            start_str = self.start_date.strftime("%d.%m.%Y")
+            out.append(f"=== АНАЛИЗ С {start_str} ===\n\n")
+        elif self.end_date:
+            end_str = self.end_date.strftime("%d.%m.%Y")
+            out.append(f"=== АНАЛИЗ ДО {end_str} ===\n\n")
+        else:
+            out.append("=== АНАЛИЗ ЗА ВСЕ ВРЕМЯ ===\n\n")
 
-            f.write("=== ГЛОБАЛЬНАЯ СТАТИСТИКА ===\n\n")
+        out.append("=== ГЛОБАЛЬНАЯ СТАТИСТИКА ===\n\n")
 
-            f.write(f"1. Всего сообщений: {global_stats['total_messages']}\n\n")
+        out.append(f"1. Всего сообщений: {global_stats['total_messages']}\n\n")
 
-            f.write("2. Топ-10 самых популярных слов:\n")
-            for i, (word, count) in enumerate(global_stats['top_words'], 1):
-                f.write(f"   {i}. {word}: {count}\n")
-            f.write("\n")
+        out.append("2. Топ-10 самых популярных слов:\n")
+        for i, (word, count) in enumerate(global_stats['top_words'], 1):
+            out.append(f"   {i}. {word}: {count}\n")
+        out.append("\n")
 
-            f.write("3. Топ-5 самых популярных стикеров:\n")
-            for i, (emoji, count, set_name, link) in enumerate(global_stats['top_stickers'], 1):
-                if emoji:
-                    f.write(f"   {i}. {emoji} (Сет: {set_name})\n")
-                    if link:
-                        f.write(f"      Ссылка для добавления: {link}\n")
-                    f.write(f"      Использований: {count}\n")
-                else:
-                    f.write(f"   {i}. Стикер не найден\n")
-            f.write("\n")
-
-            f.write(
-                f"4. Самый активный день (без фото и видео): {global_stats['active_day'][0]} ({global_stats['active_day'][1]} сообщений)\n\n")
-
-            f.write(f"5. Дней без активности: {global_stats['inactive_days']}\n\n")
-
-            f.write(f"6. Общее количество голосовых/кружочков: {global_stats['voice_count']}\n\n")
-
-            top_sender_name = global_stats['top_sender'][1] if global_stats['top_sender'] else "Нет данных"
-            f.write(
-                f"7. Самый активный участник (по сообщениям): {top_sender_name} (ID: {global_stats['top_sender'][0] if global_stats['top_sender'] else 'N/A'})\n\n")
-
-            top_voice_name = global_stats['top_voice_sender'][1] if global_stats['top_voice_sender'] else "Нет данных"
-            f.write(
-                f"8. Самый активный по голосовым: {top_voice_name} (ID: {global_stats['top_voice_sender'][0] if global_stats['top_voice_sender'] else 'N/A'})\n\n")
-
-            top_media_name = global_stats['top_media_sender'][1] if global_stats['top_media_sender'] else "Нет данных"
-            f.write(
-                f"9. Самый активный по фото/видео: {top_media_name} (ID: {global_stats['top_media_sender'][0] if global_stats['top_media_sender'] else 'N/A'})\n\n")
-
-            f.write(
-                f"10. Самый активный по словам: ID {global_stats['top_wordy_sender'][0]} ({global_stats['top_wordy_sender'][1]} слов)\n\n")
-
-            top_sticker_name = global_stats['top_sticker_sender'][1] if global_stats[
-                'top_sticker_sender'] else "Нет данных"
-            f.write(
-                f"11. Самый активный по стикерам: {top_sticker_name} (ID: {global_stats['top_sticker_sender'][0] if global_stats['top_sticker_sender'] else 'N/A'})\n\n")
-
-            f.write("12. Месяцы по активности:\n")
-            for i, (month, count) in enumerate(global_stats['monthly_ranking'], 1):
-                f.write(f"   {i}. {month}: {count} сообщений\n")
-            f.write("\n")
-
-            f.write("13. Популярные слова по месяцам:\n")
-            for month, word in global_stats['monthly_top_words'].items():
-                f.write(f"   {month}: {word}\n")
-            f.write("\n")
-
-            f.write("14. Самые активные участники по месяцам:\n")
-            for month, (name, user_id) in global_stats['monthly_top_senders'].items():
-                f.write(f"   {month}: {name} (ID: {user_id})\n")
-            f.write("\n")
-
-            f.write("=== СТАТИСТИКА ПОЛЬЗОВАТЕЛЕЙ ===\n\n")
-            for user_id, stats in user_stats.items():
-                f.write(f"--- ID: {user_id} ---\n")
-                f.write(f"1. Всего сообщений: {stats['total_messages']}\n")
-
-                f.write("2. Топ-10 слов:\n")
-                for i, (word, count) in enumerate(stats['top_words'], 1):
-                    f.write(f"   {i}. {word}: {count}\n")
-
-                emoji, count, set_name, link = stats['top_sticker']
-                if emoji:
-                    f.write(f"3. Самый популярный стикер: {emoji} (Сет: {set_name})\n")
-                    if link:
-                        f.write(f"   Ссылка для добавления: {link}\n")
-                    f.write(f"   Использований: {count}\n")
-                else:
-                    f.write("3. Самый популярный стикер: Не найдено\n")
+        out.append("3. Топ-5 самых популярных стикеров:\n")
+        for i, (emoji, count, set_name, link) in enumerate(global_stats['top_stickers'], 1):
+            if emoji:
+                out.append(f"   {i}. {emoji} (Сет: {set_name})\n")
+                if link:
+                    out.append(f"      Ссылка для добавления: {link}\n")
+                out.append(f"      Использований: {count}\n")
+            else:
+                out.append(f"   {i}. Стикер не найден\n")
+        out.append("\n")
+
+        out.append(
+            f"4. Самый активный день (без фото и видео): {global_stats['active_day'][0]} ({global_stats['active_day'][1]} сообщений)\n\n")
+
+        out.append(f"5. Дней без активности: {global_stats['inactive_days']}\n\n")
+
+        out.append(f"6. Общее количество голосовых/кружочков: {global_stats['voice_count']}\n\n")
+
+        top_sender_name = global_stats['top_sender'][1] if global_stats['top_sender'] else "Нет данных"
+        out.append(
+            f"7. Самый активный участник (по сообщениям): {top_sender_name} (ID: {global_stats['top_sender'][0] if global_stats['top_sender'] else 'N/A'})\n\n")
+
+        top_voice_name = global_stats['top_voice_sender'][1] if global_stats['top_voice_sender'] else "Нет данных"
+        out.append(
+            f"8. Самый активный по голосовым: {top_voice_name} (ID: {global_stats['top_voice_sender'][0] if global_stats['top_voice_sender'] else 'N/A'})\n\n")
+
+        top_media_name = global_stats['top_media_sender'][1] if global_stats['top_media_sender'] else "Нет данных"
+        out.append(
+            f"9. Самый активный по фото/видео: {top_media_name} (ID: {global_stats['top_media_sender'][0] if global_stats['top_media_sender'] else 'N/A'})\n\n")
+
+        out.append(
+            f"10. Самый активный по словам: ID {global_stats['top_wordy_sender'][0]} ({global_stats['top_wordy_sender'][1]} слов)\n\n")
+
+        top_sticker_name = global_stats['top_sticker_sender'][1] if global_stats[
+            'top_sticker_sender'] else "Нет данных"
+        out.append(
+            f"11. Самый активный по стикерам: {top_sticker_name} (ID: {global_stats['top_sticker_sender'][0] if global_stats['top_sticker_sender'] else 'N/A'})\n\n")
+
+        out.append("12. Месяцы по активности:\n")
+        for i, (month, count) in enumerate(global_stats['monthly_ranking'], 1):
+            out.append(f"   {i}. {month}: {count} сообщений\n")
+        out.append("\n")
+
+        out.append("13. Популярные слова по месяцам:\n")
+        for month, word in global_stats['monthly_top_words'].items():
+            out.append(f"   {month}: {word}\n")
+        out.append("\n")
+
+        out.append("14. Самые активные участники по месяцам:\n")
+        for month, (name, user_id) in global_stats['monthly_top_senders'].items():
+            out.append(f"   {month}: {name} (ID: {user_id})\n")
+        out.append("\n")
+
+        out.append("=== СТАТИСТИКА ПОЛЬЗОВАТЕЛЕЙ ===\n\n")
+        for user_id, stats in user_stats.items():
+            out.append(f"--- ID: {user_id} ---\n")
+            out.append(f"1. Всего сообщений: {stats['total_messages']}\n")
+
+            out.append("2. Топ-10 слов:\n")
+            for i, (word, count) in enumerate(stats['top_words'], 1):
+                out.append(f"   {i}. {word}: {count}\n")
+
+            emoji, count, set_name, link = stats['top_sticker']
+            if emoji:
+                out.append(f"3. Самый популярный стикер: {emoji} (Сет: {set_name})\n")
+                if link:
+                    out.append(f"   Ссылка для добавления: {link}\n")
+                out.append(f"   Использований: {count}\n")
+            else:
+                out.append("3. Самый популярный стикер: Не найдено\n")
+
+            out.append(
+                f"4. Самый активный день (без фото и видео): {stats['active_day'][0]} ({stats['active_day'][1]} сообщений)\n")
 
-                f.write(
-                    f"4. Самый активный день (без фото и видео): {stats['active_day'][0]} ({stats['active_day'][1]} сообщений)\n")
+            out.append(f"5. Дней без активности: {stats['inactive_days']}\n")
 
-                f.write(f"5. Дней без активности: {stats['inactive_days']}\n")
+            out.append(f"6. Количество голосовых: {stats['voice_count']}\n")
 
-                f.write(f"6. Количество голосовых: {stats['voice_count']}\n")
+            out.append("7. Месяцы по активности:\n")
+            for i, (month, count) in enumerate(stats['monthly_ranking'], 1):
+                out.append(f"   {i}. {month}: {count} сообщений\n")
 
-                f.write("7. Месяцы по активности:\n")
-                for i, (month, count) in enumerate(stats['monthly_ranking'], 1):
-                    f.write(f"   {i}. {month}: {count} сообщений\n")
+            out.append("\n")
 
-                f.write("\n")
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write("".join(out))
+
+    def _load_cached_dialogs(self):
+        """Возвращает сгруппированные чаты из кэша, если он не старше _DIALOGS_CACHE_TTL, иначе None"""
+        try:
+            with closing(sqlite3.connect(_DIALOGS_CACHE_PATH)) as conn:
+                row = conn.execute(
+                    "SELECT fetched_at, payload FROM dialogs_cache WHERE session = ?", (self.session_name,)
+                ).fetchone()
+        except sqlite3.Error:
+            return None  # Кэша еще нет или он поврежден - получим диалоги заново
+
+        if not row or row[0] < time.time() - _DIALOGS_CACHE_TTL:
+            return None
+        try:
+            return {
+                group: [(chat_id, title, datetime.fromisoformat(last) if last else None) for chat_id, title, last in chats]
+                for group, chats in json.loads(row[1]).items()
+            }
+        except (ValueError, TypeError, AttributeError):
+            return None  # Запись повреждена - получим диалоги заново
+
+    def _save_cached_dialogs(self, chat_groups: Dict[str, list]):
+        """Сохраняет сгруппированные чаты в кэш диалогов"""
+        payload = json.dumps({
+            group: [(chat_id, title, last.isoformat() if last else None) for chat_id, title, last in chats]
+            for group, chats in chat_groups.items()
+        }, ensure_ascii=False)
+        try:
+            with closing(sqlite3.connect(_DIALOGS_CACHE_PATH)) as conn, conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS dialogs_cache (
+                        session TEXT PRIMARY KEY,
+                        fetched_at REAL,
+                        payload TEXT
+                    )
+                """)
+                conn.execute(
+                    "INSERT OR REPLACE INTO dialogs_cache VALUES (?, ?, ?)",
+                    (self.session_name, time.time(), payload)
+                )
+        except sqlite3.Error as e:
+            # Без кэша программа работает, просто следующий запуск снова обойдет диалоги
+            print(f"Не удалось сохранить кэш диалогов: {e}")
+
+    async def get_sorted_chats(self, refresh: bool = False, top: int = None):
+        """Получает список чатов с группировкой и сортировкой (не больше top последних в каждой группе)
+
+        Результат берется из кэша диалогов, если он свежий и не указан refresh.
+        """
+        if not refresh:
+            cached = self._load_cached_dialogs()
+            if cached is not None:
+                return {group: _latest_chats(chats, top) for group, chats in cached.items()}
 
-    async def get_sorted_chats(self):
-        """Получает список чатов с группировкой и сортировкой"""
         chat_groups = {
             "channels": [],
             "groups": [],
@@ -672,80 +1061,56 @@ class ChatAnalyzer:
             "unnamed": []
         }
 
-        # Получаем все диалоги
-        dialogs = []
+        # Раскладываем диалоги по группам сразу при получении, без промежуточного списка
+        complete = True
         try:
             async for dialog in self.client.get_dialogs():
-                dialogs.append(dialog)
+                chat = dialog.chat
+                title = chat.title
+                last_message_date = dialog.top_message.date if dialog.top_message else None
+
+                # Группа по типу чата; без известного типа - по наличию названия
+                group = _CHAT_TYPE_GROUPS.get(getattr(chat.type, "value", chat.type))
+                if group is None:
+                    group = "unnamed" if not title or title == "Без названия" else "groups"
+                chat_groups[group].append((chat.id, title or "Без названия", last_message_date))
         except Exception as e:
             print(f"Ошибка при получении списка чатов: {e}")
-            return chat_groups
-
-        # Для каждого типа чата получаем последнее сообщение
-        for dialog in dialogs:
-            chat = dialog.chat
-            last_message_date = dialog.top_message.date if dialog.top_message else None
-
-            # Определяем тип чата
-            if chat.type == "channel":
-                chat_groups["channels"].append((chat.id, chat.title or "Без названия", last_message_date))
-            elif chat.type in ["group", "supergroup"]:
-                chat_groups["groups"].append((chat.id, chat.title or "Без названия", last_message_date))
-            elif chat.type == "private":
-                chat_groups["private"].append((chat.id, chat.title or "Без названия", last_message_date))
-            else:
-                # Если название отсутствует или пустое
-                if not chat.title or chat.title == "Без названия":
-                    chat_groups["unnamed"].append((chat.id, "Без названия", last_message_date))
-                else:
-                    # Если тип не определен, но есть название - относим к группе "другое"
-                    chat_groups["groups"].append((chat.id, chat.title, last_message_date))
+            complete = False
 
-        # Сортируем каждую группу по дате последнего сообщения (новые первыми)
-        for group in chat_groups.values():
-            group.sort(key=lambda x: x[2] or datetime.min, reverse=True)
+        # В кэш попадают все чаты, чтобы следующий запуск мог показать другое их количество.
+        # Неполный список не кэшируем, чтобы следующий запуск получил его заново
+        if complete:
+            self._save_cached_dialogs(chat_groups)
 
-        return chat_groups
+        # Сортируем каждую группу по дате последнего сообщения (новые первыми)
+        return {group: _latest_chats(chats, top) for group, chats in chat_groups.items()}
 
-    async def run_interactive(self):
+    async def run_interactive(self, refresh_dialogs: bool = False, top: int = None):
         """Запуск в интерактивном режиме"""
         await self.client.start()
 
         print("Доступные чаты:")
-        chat_groups = await self.get_sorted_chats()
-
-        # Выводим отсортированные и сгруппированные чаты
-        if chat_groups["channels"]:
-            print("\n--- КАНАЛЫ ---")
-            for chat_id, title, last_msg_date in chat_groups["channels"]:
-                date_str = last_msg_date.strftime("%Y-%m-%d %H:%M:%S") if last_msg_date else "Нет данных"
-                print(f"{chat_id} - {title} (Посл. сообщение: {date_str})")
-
-        if chat_groups["groups"]:
-            print("\n--- ГРУППЫ ---")
-            for chat_id, title, last_msg_date in chat_groups["groups"]:
-                date_str = last_msg_date.strftime("%Y-%m-%d %H:%M:%S") if last_msg_date else "Нет данных"
-                print(f"{chat_id} - {title} (Посл. сообщение: {date_str})")
-
-        if chat_groups["private"]:
-            print("\n--- ЛИЧНЫЕ ЧАТЫ ---")
-            for chat_id, title, last_msg_date in chat_groups["private"]:
-                date_str = last_msg_date.strftime("%Y-%m-%d %H:%M:%S") if last_msg_date else "Нет данных"
-                print(f"{chat_id} - {title} (Посл. сообщение: {date_str})")
-
-        if chat_groups["unnamed"]:
-            print("\n--- БЕЗ НАЗВАНИЯ ---")
-            for chat_id, title, last_msg_date in chat_groups["unnamed"]:
-                date_str = last_msg_date.strftime("%Y-%m-%d %H:%M:%S") if last_msg_date else "Нет данных"
-                print(f"{chat_id} - {title} (Посл. сообщение: {date_str})")
+        chat_groups = await self.get_sorted_chats(refresh=refresh_dialogs, top=top)
+
+        # Выводим отсортированные и сгруппированные чаты одним вызовом print
+        lines = []
+        for group, header in _CHAT_GROUP_HEADERS.items():
+            if chat_groups[group]:
+                lines.append(f"\n--- {header} ---")
+                lines.extend(
+                    f"{chat_id} - {title} (Посл. сообщение: {_format_chat_date(last_msg_date)})"
+                    for chat_id, title, last_msg_date in chat_groups[group]
+                )
+        if lines:
+            print("\n".join(lines))
 
         while True:
-            try:
-                chat_id_input = input("\nВведите ID чата для анализа: ")
+            chat_id_input = input("\nВведите ID чата для анализа: ").strip()
+            if _INT_RE.fullmatch(chat_id_input):
                 self.chat_id = int(chat_id_input)
                 break
-            except ValueError:
-                print("Некорректный ID чата. Пожалуйста, введите целое число.")
+            print("Некорректный ID чата. Пожалуйста, введите целое число.")
 
         # Запрашиваем период анализа
         print("\nВведите период анализа (формат: день.месяц.год)")
@@ -755,31 +1120,15 @@ class ChatAnalyzer:
         start_input = input("Начальная дата (день.месяц.год): ").strip()
         end_input = input("Конечная дата (день.месяц.год): ").strip()
 
-        if start_input:
-            try:
-                self.start_date = self.parse_date(start_input)
-            except ValueError as e:
-                print(f"Ошибка: {e}")
-                return
-        else:
-            self.start_date = None
-
-        if end_input:
-            try:
-                self.end_date = self.parse_date(end_input)
-                # Проверяем корректность диапазона
-                if self.start_date and self.end_date < self.start_date:
-                    print("Ошибка: конечная дата не может быть раньше начальной")
-                    return
-            except ValueError as e:
-                print(f"Ошибка: {e}")
-                return
-        else:
-            self.end_date = None
+        try:
+            self.start_date, self.end_date = _resolve_range(start_input, end_input)
+        except ValueError as e:
+            print(f"Ошибка: {e}")
+            return
 
         # Проверяем доступ к чату
         try:
-            await self.client.get_chat(self.chat_id)
+            self._chat = await self.client.get_chat(self.chat_id)
         except ChatForbidden:
             print("Доступ к чату запрещен. Возможно, вы покинули чат или были заблокированы.")
             return
@@ -787,58 +1136,26 @@ class ChatAnalyzer:
             print(f"Ошибка при доступе к чату: {e}")
             return
 
-        db_path = f"chat_{abs(self.chat_id)}.db"
-        self.init_db(db_path)
-
-        await self.fetch_messages()
-
-        print("Начинаю анализ...")
-        global_stats = self.analyze_global_stats()
-
-        # Получаем всех пользователей (без ограничения)
-        cursor = self.db_conn.cursor()
-        cursor.execute("SELECT DISTINCT sender_id FROM messages WHERE sender_id IS NOT NULL")
-        user_ids = [row[0] for row in cursor.fetchall()]
-
-        user_stats = {}
-        for user_id in user_ids:  # Убрано ограничение на 10
-            user_stats[user_id] = self.analyze_user_stats(user_id)
-
-        output_file = f"analysis_{abs(self.chat_id)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        self.export_results(global_stats, user_stats, output_file)
-
-        print(f"Анализ завершен. Результаты сохранены в {output_file}")
+        # Имена файлов строятся от одного и того же ID без знака
+        chat_slug = abs(self.chat_id)
+        db_path = f"chat_{chat_slug}.db"
+        output_file = f"analysis_{chat_slug}_{datetime.now():%Y%m%d_%H%M%S}.txt"
+        await self._analyze_and_export(db_path, output_file)
 
     async def run_with_args(self, chat_id: int, start_date: str, end_date: str, db_path: str, output_file: str):
         """Запуск с аргументами командной строки"""
-        await self.client.start()
-
-        # Парсим даты
-        if start_date:
-            try:
-                self.start_date = self.parse_date(start_date)
-            except ValueError as e:
-                print(f"Ошибка: {e}")
-                return
-        else:
-            self.start_date = None
+        # Проверяем даты до подключения к Telegram
+        try:
+            self.start_date, self.end_date = _resolve_range(start_date, end_date)
+        except ValueError as e:
+            print(f"Ошибка: {e}")
+            return
 
-        if end_date:
-            try:
-                self.end_date = self.parse_date(end_date)
-                # Проверяем корректность диапазона
-                if self.start_date and self.end_date < self.start_date:
-                    print("Ошибка: конечная дата не может быть раньше начальной")
-                    return
-            except ValueError as e:
-                print(f"Ошибка: {e}")
-                return
-        else:
-            self.end_date = None
+        await self.client.start()
 
         # Проверяем доступ к чату
         try:
-            await self.client.get_chat(chat_id)
+            self._chat = await self.client.get_chat(chat_id)
         except ChatForbidden:
             print("Доступ к чату запрещен. Возможно, вы покинули чат или были заблокированы.")
             return
@@ -847,27 +1164,47 @@ class ChatAnalyzer:
             return
 
         self.chat_id = chat_id
-        self.init_db(db_path)
-
-        await self.fetch_messages()
+        await self._analyze_and_export(db_path, output_file)
 
-        print("Начинаю анализ...")
-        global_stats = self.analyze_global_stats()
+    async def _analyze_and_export(self, db_path: str, output_file: str):
+        """Загружает сообщения выбранного чата, анализирует их и сохраняет отчет
 
-        # Получаем всех пользователей (без ограничения)
-        cursor = self.db_conn.cursor()
-        cursor.execute("SELECT DISTINCT sender_id FROM messages WHERE sender_id IS NOT NULL")
-        user_ids = [row[0] for row in cursor.fetchall()]
+        chat_id и период анализа должны быть заданы заранее.
+        """
+        self.init_db(db_path)
 
-        user_stats = {}
-        for user_id in user_ids:  # Убрано ограничение на 10
-            user_stats[user_id] = self.analyze_user_stats(user_id)
+        await self.fetch_messages()
+        self.create_indexes()
+
+        # Повторный запуск за тот же период без новых сообщений не пересчитывает статистику
+        cache_key = self._stats_cache_key()
+        cached = self._load_cached_stats(cache_key)
+        if cached is not None:
+            print("Новых сообщений нет, используется сохраненная статистика")
+            global_stats, user_stats = cached
+        else:
+            print("Начинаю анализ...")
+            # Глобальная статистика и статистика всех пользователей (без ограничения) считаются параллельно
+            global_stats, user_stats = await self.run_analysis()
+            self._save_cached_stats(cache_key, (global_stats, user_stats))
 
         self.export_results(global_stats, user_stats, output_file)
 
         print(f"Анализ завершен. Результаты сохранены в {output_file}")
 
 
+def _positive_int(value: str) -> int:
+    """Тип аргумента командной строки: целое число не меньше 1"""
+    # Значение подставляется в текст PRAGMA, поэтому проверяется до открытия базы
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается целое число: {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"значение должно быть не меньше 1: {value}")
+    return number
+
+
 def main():
     load_dotenv(".env")
     parser = argparse.ArgumentParser(description="Telegram Chat Analyzer Userbot")
@@ -876,6 +1213,12 @@ def main():
     parser.add_argument("--end_date", type=str, help="Конечная дата в формате день.месяц.год (например: 31.12.2023)")
     parser.add_argument("--db_path", type=str, default="chat_data.db", help="Путь к базе данных")
     parser.add_argument("--output", type=str, default="results.txt", help="Файл для вывода результатов")
+    parser.add_argument("--no_wal", action="store_true", help="Не использовать WAL-журнал SQLite (например, для сетевых дисков)")
+    parser.add_argument("--refresh_dialogs", action="store_true",
+                        help="Получить список чатов заново, не используя кэш диалогов")
+    parser.add_argument("--cache_size", type=_positive_int, default=64,
+                        help="Размер кэша страниц SQLite в МБ на соединение (для больших чатов можно увеличить)")
+    parser.add_argument("--top", type=_positive_int, help="Показывать не больше N последних чатов в каждой группе")
 
     # Парсим только известные аргументы, игнорируя лишние
     args, unknown = parser.parse_known_args()
@@ -888,11 +1231,12 @@ def main():
         print("Пожалуйста, укажите API_ID и API_HASH в переменных окружения")
         return
 
-    analyzer = ChatAnalyzer("analyzer_session", api_id, api_hash)
+    analyzer = ChatAnalyzer("analyzer_session", api_id, api_hash, use_wal=not args.no_wal,
+                            cache_size_mb=args.cache_size)
 
     # Если не переданы аргументы (или передан только --help), запускаем интерактивный режим
     if not args.chat_id:
-        asyncio.run(analyzer.run_interactive())
+        asyncio.run(analyzer.run_interactive(refresh_dialogs=args.refresh_dialogs, top=args.top))
     else:
         asyncio.run(analyzer.run_with_args(args.chat_id, args.start_date, args.end_date, args.db_path, args.output))
 